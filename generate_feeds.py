@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import argparse
 import configparser
+import functools
+import itertools
 import logging
 import os
-from datetime import timedelta
+import shutil
+import tempfile
+import time
+import types
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
 
-import arrow
-import caldav
-import foursquare
 from dateutil.tz import tzoffset
-from ics import Calendar, Event
+
+# foursquare (which pulls in requests), ics and caldav are slow to import,
+# so they're only imported where they're needed.
+if TYPE_CHECKING:
+    import foursquare
+    from ics import Calendar, Event
 
 current_dir = os.path.realpath(os.path.dirname(__file__))
 CONFIG_FILE = os.path.join(current_dir, "config.ini")
@@ -17,147 +31,437 @@ CONFIG_FILE = os.path.join(current_dir, "config.ini")
 # The kinds of file we can generate:
 VALID_KINDS = ["ics", "caldav"]
 
+# The PRODID to use in generated calendars:
+ICS_PRODID = "-//foursquare-feeds//EN"
+
+# The maximum number of checkins the API will return per request:
+PAGE_SIZE = 250
+
+# How many pages of checkins to fetch at once when fetching all of them.
+# Kept small so we don't trip the API's rate limit:
+MAX_WORKERS = 8
+
+# How many times to retry a rate-limited request, and the initial number of
+# seconds to wait before doing so (doubled on each retry):
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BACKOFF = 5
+
+# How many times, and with what backoff factor, to retry API requests that
+# fail to connect or get a temporary server error. Rate limits are retried
+# separately, using RATE_LIMIT_RETRIES and RATE_LIMIT_BACKOFF:
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+
+
+def _decode_with_orjson(response, *args, **kwargs):
+    """A requests response hook that makes response.json() decode with
+    orjson, which is much faster for large pages of checkins.
+
+    Calls that pass arguments to json() still use requests' own decoding.
+    """
+    import orjson
+
+    default_json = response.json
+
+    def json(**kwargs):
+        if kwargs:
+            return default_json(**kwargs)
+        return orjson.loads(response.content)
+
+    response.json = json
+    return response
+
+
+@functools.cache
+def _use_session():
+    """Make the foursquare module send its requests through one
+    requests.Session, so connections to the API are kept alive and reused
+    instead of making a new TLS connection for every page of checkins.
+
+    The foursquare module calls requests.get() and requests.post() itself,
+    with no way to pass it a session, so we replace its reference to
+    requests with one whose get() and post() use our session.
+
+    If orjson is installed, the session's responses are decoded with it.
+
+    Only done once, however many clients are created.
+    """
+    import foursquare
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # The foursquare module is set to make only one attempt at each request,
+    # so this is the one place failed connections and server errors are
+    # retried. Rate limits aren't retried here; _get_checkins_from_api()
+    # backs off from those.
+    retries = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        # Any server error the foursquare module would have retried itself:
+        status_forcelist=[500, 502, 503, 504],
+        # Let the foursquare module handle the final response as usual:
+        raise_on_status=False,
+    )
+    # Enough connections for all the threads fetching pages at once:
+    adapter = HTTPAdapter(pool_maxsize=MAX_WORKERS, max_retries=retries)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+
+    try:
+        import orjson  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        session.hooks["response"].append(_decode_with_orjson)
+
+    foursquare.requests = types.SimpleNamespace(
+        get=session.get,
+        post=session.post,
+        exceptions=requests.exceptions,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _read_config(config_file: str, mtime: float) -> dict:
+    """Parses the config file and returns a dict of the settings we use.
+
+    Cached, so repeatedly loading the same config file only parses it once.
+    The file's modification time is part of the cache key so that the file
+    is re-read if it changes.
+
+    Keyword arguments:
+    config_file -- Path to the config file.
+    mtime -- The config file's modification time.
+    """
+    config = configparser.ConfigParser()
+
+    with open(config_file) as f:
+        config.read_file(f)
+
+    return {
+        "api_access_token": config.get("Foursquare", "AccessToken"),
+        "ics_filepath": config.get("Local", "IcsFilepath"),
+        "caldav_url": config.get("CalDAV", "url", fallback=None),
+        "caldav_username": config.get("CalDAV", "username", fallback=None),
+        "caldav_password": config.get("CalDAV", "password", fallback=None),
+        "caldav_calendar_name": config.get(
+            "CalDAV", "calendar_name", fallback="Foursquare"
+        ),
+    }
+
+
+@functools.lru_cache(maxsize=64)
+def _tz_for_offset(minutes: int) -> tzoffset:
+    """Returns a tzoffset for an offset from UTC in minutes.
+
+    Cached, because a user's checkins will only have a handful of different
+    offsets between them.
+
+    Keyword arguments:
+    minutes -- The offset from UTC, in minutes.
+    """
+    return tzoffset(None, minutes * 60)
+
 
 class FeedGenerator:
     fetch = "recent"
 
     def __init__(self, config_file=CONFIG_FILE, fetch="recent"):
-        "Loads config, sets up Foursquare API client."
+        "Loads config. The Foursquare API client is set up when first used."
 
         self.fetch = fetch
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        # Details about the authenticated user, fetched when first needed:
+        self._user = None
+
         self._load_config(config_file)
 
-        self.client = foursquare.Foursquare(access_token=self.api_access_token)
+    @functools.cached_property
+    def client(self) -> foursquare.Foursquare:
+        "The Foursquare API client, created the first time it's needed."
+        import foursquare
+
+        # We back off and retry rate-limited requests ourselves, in
+        # _get_checkins_from_api(), and the session retries other failures,
+        # so have the foursquare module only make one attempt at each request
+        # rather than retrying them as well:
+        foursquare.NUM_REQUEST_RETRIES = 1
+
+        _use_session()
+
+        return foursquare.Foursquare(access_token=self.api_access_token)
 
     def _load_config(self, config_file):
         "Set object variables based on supplied config file."
-        config = configparser.ConfigParser()
-
         try:
-            config.read_file(open(config_file))
+            mtime = os.stat(config_file).st_mtime
+            config = _read_config(config_file, mtime)
         except IOError:
             self.logger.critical("Can't read config file: " + config_file)
             exit()
 
-        self.api_access_token = config.get("Foursquare", "AccessToken")
-        self.ics_filepath = config.get("Local", "IcsFilepath")
-        self.caldav_url = config.get("CalDAV", "url", fallback=None)
-        self.caldav_username = config.get("CalDAV", "username", fallback=None)
-        self.caldav_password = config.get("CalDAV", "password", fallback=None)
-        self.caldav_calendar_name = config.get("CalDAV", "calendar_name", fallback="Foursquare")
+        for name, value in config.items():
+            setattr(self, name, value)
+
+    def generate(
+        self, kinds: str | Iterable[str] = ("ics",), kind: str | None = None
+    ):
+        """Call this to fetch the data from the API and generate the file,
+        and/or sync to CalDAV.
+
+        The checkins are only fetched once, however many kinds are requested.
+
+        Keyword arguments:
+        kinds -- One of VALID_KINDS, or an iterable of them.
+        kind -- Optional. A single one of VALID_KINDS, for compatibility with
+                older versions. If it's given, kinds is ignored.
+        """
+        if kind is not None:
+            kinds = kind
+        if isinstance(kinds, str):
+            kinds = [kinds]
+        kinds = list(dict.fromkeys(kinds))
+        for k in kinds:
+            if k not in VALID_KINDS:
+                raise ValueError(
+                    "kind should be one of {}.".format(", ".join(VALID_KINDS))
+                )
+
+        checkins = self._iter_checkins()
+        if len(kinds) > 1:
+            # Every kind needs to go through all the checkins:
+            checkins = list(checkins)
+
+        if "ics" in kinds:
+            filepath = self._generate_ics_file(checkins)
+            self.logger.info("Generated file {}".format(filepath))
+
+        if "caldav" in kinds:
+            self.sync_calendar_to_caldav(checkins)
 
-    def generate(self, kind: str = "ics"):
-        "Call this to fetch the data from the API and generate the file."
-        if kind not in VALID_KINDS:
-            raise ValueError("kind should be one of {}.".format(", ".join(VALID_KINDS)))
+    def _iter_checkins(self) -> Iterator[dict]:
+        """Yields checkins from the API, newest first: either the most
+        recent ones or all of them, depending on self.fetch.
 
+        Each checkin is only yielded once, even if the API returns it more
+        than once. This can happen when fetching all checkins if new ones are
+        made while we're paging through them, shifting the offsets.
+
+        Logs how many were fetched once they've all been yielded.
+        """
         if self.fetch == "all":
-            checkins = self._get_all_checkins()
+            checkins = self._iter_all_checkins()
         else:
-            checkins = self._get_recent_checkins()
+            checkins = self._iter_recent_checkins()
 
-        plural = "" if len(checkins) == 1 else "s"
-        self.logger.info("Fetched {} checkin{} from the API".format(len(checkins), plural))
-
-        if kind == "ics":
-            calendar = self._generate_calendar(checkins)
+        seen_ids = set()
+        for checkin in checkins:
+            if checkin["id"] in seen_ids:
+                self.logger.debug("Skipping duplicate checkin {}".format(checkin["id"]))
+                continue
+            seen_ids.add(checkin["id"])
+            yield checkin
 
-            with open(self.ics_filepath, "w") as f:
-                f.writelines(calendar)
+        count = len(seen_ids)
 
-            self.logger.info("Generated file {}".format(self.ics_filepath))
+        plural = "" if count == 1 else "s"
+        self.logger.info("Fetched {} checkin{} from the API".format(count, plural))
 
-    def _get_recent_checkins(self) -> list:
+    def _iter_recent_checkins(self) -> Iterator[dict]:
         "Make one request to the API for the most recent checkins."
         results = self._get_checkins_from_api()
-        return results["checkins"]["items"]
+        yield from results["checkins"]["items"]
 
-    def _get_all_checkins(self) -> list:
-        "Make multiple requests to the API to get ALL checkins."
-        offset = 0
-        checkins = []
-        # Temporary total:
-        total_checkins = 9999999999
+    def _iter_all_checkins(self) -> Iterator[dict]:
+        """Make multiple requests to the API to get ALL checkins.
 
+        Each page's checkins are yielded as soon as that page arrives,
+        rather than collecting every page into one list first. At most
+        MAX_WORKERS pages are requested ahead of the one being yielded, so
+        only that many pages are held in memory at once.
+        """
         self.logger.debug("Fetching all checkins...")
-        # Loop until we have fetched all checkins:
-        while offset < total_checkins:
-            results = self._get_checkins_from_api(offset)
-            self.logger.debug("Got {} checkins from API with offset {}".format(
-                results["checkins"]["count"], offset
-            ))
-
-            if offset == 0:
-                # First time, set the correct total:
-                total_checkins = results["checkins"]["count"]
-                plural = "" if total_checkins == 1 else "s"
-                self.logger.debug("{} checkin{} to fetch".format(total_checkins, plural))
-
-            self.logger.debug("Fetched {}-{}".format(offset + 1, offset + 250))
 
-            checkins += results["checkins"]["items"]
-            offset += 250
+        # The first page tells us how many checkins there are in total:
+        results = self._get_checkins_from_api(0)
+        total_checkins = results["checkins"]["count"]
+        plural = "" if total_checkins == 1 else "s"
+        self.logger.debug("{} checkin{} to fetch".format(total_checkins, plural))
+        self.logger.debug("Fetched 1-{}".format(PAGE_SIZE))
+
+        yield from results["checkins"]["items"]
+
+        # Then fetch the remaining pages in parallel, keeping a window of
+        # MAX_WORKERS requests in flight. Pages are yielded in offset order,
+        # so the checkins stay newest first.
+        offsets = iter(range(PAGE_SIZE, total_checkins, PAGE_SIZE))
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pending = deque(
+                (offset, executor.submit(self._get_checkins_from_api, offset))
+                for offset in itertools.islice(offsets, MAX_WORKERS)
+            )
+            while pending:
+                offset, future = pending.popleft()
+                results = future.result()
+
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append(
+                        (
+                            next_offset,
+                            executor.submit(self._get_checkins_from_api, next_offset),
+                        )
+                    )
 
-        return checkins
+                self.logger.debug("Fetched {}-{}".format(offset + 1, offset + PAGE_SIZE))
+                yield from results["checkins"]["items"]
 
     def _get_checkins_from_api(self, offset: int = 0) -> list:
         """Returns a list of recent checkins for the authenticated user.
 
+        If the API's rate limit is hit, waits and tries again, up to
+        RATE_LIMIT_RETRIES times. This is the only place rate-limited
+        requests are retried.
+
         Keyword arguments:
         offset -- Integer, the offset number to send to the API.
                   The number of results to skip.
         """
+        import foursquare
 
-        try:
-            res = self.client.users.checkins(
-                params={"limit": 250, "offset": offset, "sort": "newestfirst"}
-            )
-            self.logger.debug("Results: {}".format(res))
-            return res
-        except foursquare.FoursquareException as err:
-            self.logger.error(
-                "Error getting checkins, with offset of {}: {}".format(offset, err)
-            )
-            exit(1)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                res = self.client.users.checkins(
+                    params={"limit": PAGE_SIZE, "offset": offset, "sort": "newestfirst"}
+                )
+                self.logger.debug("Results: {}".format(res))
+                return res
+            except foursquare.RateLimitExceeded as err:
+                if attempt == RATE_LIMIT_RETRIES:
+                    self.logger.error(
+                        "Rate limited getting checkins, with offset of {}: {}".format(
+                            offset, err
+                        )
+                    )
+                    exit(1)
+                wait = RATE_LIMIT_BACKOFF * 2**attempt
+                self.logger.debug(
+                    "Rate limited with offset of {}, retrying in {}s".format(offset, wait)
+                )
+                time.sleep(wait)
+            except foursquare.FoursquareException as err:
+                self.logger.error(
+                    "Error getting checkins, with offset of {}: {}".format(offset, err)
+                )
+                exit(1)
 
     def _get_user(self):
-        "Returns details about the authenticated user."
-        try:
-            user = self.client.users()
-        except foursquare.FoursquareException as err:
-            self.logger.error("Error getting user: {}".format(err))
-            exit(1)
+        """Returns details about the authenticated user.
+
+        Only requested from the API once; later calls return the same data.
+        """
+        if self._user is None:
+            import foursquare
+
+            try:
+                user = self.client.users()
+            except foursquare.FoursquareException as err:
+                self.logger.error("Error getting user: {}".format(err))
+                exit(1)
+
+            self._user = user["user"]
 
-        return user["user"]
+        return self._user
 
-    def _generate_ics_file(self, checkins: list) -> str:
-        """Supplied with a list of checkin data from the API, generates
+    def _generate_ics_file(self, checkins: Iterable[dict]) -> str:
+        """Supplied with checkin data from the API, generates
         and saves a .ics file.
 
+        Each event is written to the file as soon as it's generated, rather
+        than building a whole Calendar in memory first. Checkins may still be
+        arriving from the API while this happens, so we write to a temporary
+        file next to it and only replace the existing one once it's complete.
+        If IcsFilepath is a symlink, the file it points to is replaced.
+
         Returns the filepath of the saved file.
 
         Keyword arguments:
-        checkins -- A list of dicts, each one data about a single checkin.
+        checkins -- An iterable of dicts, each one data about a single checkin.
         """
-        calendar = self._generate_calendar(checkins)
-
-        with open(self.ics_filepath, "w") as f:
-            f.writelines(calendar)
+        filepath = os.path.realpath(self.ics_filepath)
+
+        f = tempfile.NamedTemporaryFile(
+            mode="w",
+            dir=os.path.dirname(filepath),
+            prefix=os.path.basename(filepath) + ".",
+            suffix=".tmp",
+            delete=False,
+        )
+        try:
+            with f:
+                f.write("BEGIN:VCALENDAR\r\n")
+                f.write("VERSION:2.0\r\n")
+                f.write("PRODID:{}\r\n".format(ICS_PRODID))
+
+                for event in self._generate_events(checkins):
+                    f.write(event.serialize())
+                    f.write("\r\n")
+
+                f.write("END:VCALENDAR\r\n")
+
+            # NamedTemporaryFile is only readable by us, but the .ics file
+            # may be served publicly, so keep the existing file's permissions
+            # and group, or give a new file the usual permissions:
+            if os.path.exists(filepath):
+                shutil.copymode(filepath, f.name)
+                try:
+                    os.chown(f.name, -1, os.stat(filepath).st_gid)
+                except PermissionError:
+                    pass
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(f.name, 0o666 & ~umask)
+
+            os.replace(f.name, filepath)
+        except BaseException:
+            # Including the SystemExit from an API error part way through:
+            os.unlink(f.name)
+            raise
 
         return self.ics_filepath
 
-    def _generate_calendar(self, checkins: list) -> Calendar:
-        """Supplied with a list of checkin data from the API, generates
+    def _generate_calendar(self, checkins: Iterable[dict]) -> Calendar:
+        """Supplied with checkin data from the API, generates
         an ics Calendar object and returns it.
 
         Keyword arguments:
-        checkins -- A list of dicts, each one data about a single checkin.
+        checkins -- An iterable of dicts, each one data about a single checkin.
         """
-        user = self._get_user()
+        from ics import Calendar
+
+        c = Calendar(creator=ICS_PRODID)
+
+        for e in self._generate_events(checkins):
+            c.events.add(e)
 
-        c = Calendar()
+        return c
+
+    def _generate_events(self, checkins: Iterable[dict]) -> Iterator[Event]:
+        """Supplied with checkin data from the API, generates
+        an ics Event for each checkin that has a venue.
+
+        Keyword arguments:
+        checkins -- An iterable of dicts, each one data about a single checkin.
+        """
+        # Only needed when generating events, and slow to import:
+        from ics import Event
+
+        user = self._get_user()
+        url_prefix = user["canonicalUrl"] + "/checkin/"
 
         for checkin in checkins:
             if "venue" not in checkin:
@@ -166,19 +470,20 @@ class FeedGenerator:
                 continue
 
             venue_name = checkin["venue"]["name"]
-            tz_offset = tzoffset(None, checkin["timeZoneOffset"] * 60)
+            tz_offset = self._get_checkin_timezone(checkin)
 
             e = Event()
-            start = arrow.get(checkin["createdAt"]).replace(tzinfo=tz_offset)
+            start = datetime.fromtimestamp(checkin["createdAt"], tz=tz_offset)
+            end = start + timedelta(minutes=15)
 
-            e.name = "@ {}".format(venue_name)
-            e.location = venue_name
-            e.url = "{}/checkin/{}".format(user["canonicalUrl"], checkin["id"])
+            e.name = f"@ {venue_name}"
+            e.url = url_prefix + checkin["id"]
             e.uid = checkin["id"]
             e.begin = start
-            e.end = start + timedelta(minutes=15)
-            e.created = start + timedelta(minutes=15)
-            e.last_modified = start + timedelta(minutes=15)
+            e.end = end
+            # Reuse the Arrow that ics converted end to, rather than having
+            # it convert the same datetime twice more:
+            e.created = e.last_modified = e.end
 
             # Use the 'shout', if any, and the timezone offset in the
             # description.
@@ -186,39 +491,58 @@ class FeedGenerator:
             if "shout" in checkin and len(checkin["shout"]) > 0:
                 description = [checkin["shout"]]
             if "beenHere" in checkin and checkin["beenHere"]['lastCheckinExpiredAt'] > 0:
+                last_checkin = datetime.fromtimestamp(
+                    checkin["beenHere"]["lastCheckinExpiredAt"], tz=timezone.utc
+                )
+                days = (start - last_checkin).days
                 description.append(
-                    "It has been {} days since you last checked in here.".format(
-                        (start - arrow.get(checkin["beenHere"]["lastCheckinExpiredAt"])).days
-                    )
+                    f"It has been {days} days since you last checked in here."
                 )
             if "isMayor" in checkin and checkin["isMayor"]:
                 description.append("At this time, you were the mayor of this venue!")
             e.description = "\n".join(description)
 
             # Use the venue_name and the address, if any, for the location.
-            location = venue_name
-            if "location" in checkin["venue"]:
-                loc = checkin["venue"]["location"]
-                if "formattedAddress" in loc and len(loc["formattedAddress"]) > 0:
-                    address = ", ".join(loc["formattedAddress"])
-                    location = "{}, {}".format(location, address)
-            e.location = location
+            address = self._format_address(checkin["venue"])
+            if address:
+                e.location = f"{venue_name}, {address}"
+            else:
+                e.location = venue_name
 
-            c.events.add(e)
+            yield e
 
-        return c
+    def _get_checkin_timezone(self, checkin: dict) -> tzoffset:
+        """Returns a tzoffset object for the checkin's timezone.
+
+        Keyword arguments:
+        checkin -- A dict of data about a single checkin.
+        """
+        return _tz_for_offset(checkin["timeZoneOffset"])
 
-    def sync_calendar_to_caldav(self):
+    @staticmethod
+    def _format_address(venue: dict) -> str | None:
+        """Returns the venue's address as a single comma-separated string,
+        or None if it doesn't have one.
+
+        Keyword arguments:
+        venue -- A dict of data about a venue, from a checkin.
+        """
+        address = venue.get("location", {}).get("formattedAddress")
+        if address:
+            return ", ".join(address)
+        return None
+
+    def sync_calendar_to_caldav(self, checkins: Iterable[dict] | None = None):
         """
         Syncs all events from the generated calendar to a CalDAV server.
         Uses credentials and URL from the instance config.
-        """
 
-        if self.fetch == "all":
-            checkins = self._get_all_checkins()
-        else:
-            checkins = self._get_recent_checkins()
-        calendar = self._generate_calendar(checkins)
+        Keyword arguments:
+        checkins -- An iterable of dicts, each one data about a single checkin.
+                    If None, they're fetched from the API.
+        """
+        # Only needed here, and slow to import:
+        import caldav
 
         # Connect to CalDAV server using instance variables
         client = caldav.DAVClient(
@@ -241,12 +565,96 @@ class FeedGenerator:
             self.logger.info("Creating new calendar: {}".format(self.caldav_calendar_name))
             cal = principal.make_calendar(name=self.caldav_calendar_name)
 
+        existing_events = self._get_existing_events(cal)
+
+        if checkins is None:
+            checkins = self._iter_checkins()
+
+        # Checkins don't change once they've happened, so only generate and
+        # upload events for checkins that aren't already on the server.
+        # Events whose start time is wrong (e.g. synced by an older version)
+        # are uploaded again, which overwrites them by UID.
+        new_checkins = []
+        skipped = 0
+        for checkin in checkins:
+            if "venue" not in checkin:
+                # These never become events, so are never on the server.
+                continue
+            server_event = existing_events.get(checkin["id"])
+            if server_event is not None and self._is_event_current(
+                server_event, checkin
+            ):
+                skipped += 1
+            else:
+                new_checkins.append(checkin)
+        plural = "" if len(new_checkins) == 1 else "s"
+        self.logger.info(
+            "Found {} new checkin{}, skipping {} already on the server".format(
+                len(new_checkins), plural, skipped
+            )
+        )
+        if not new_checkins:
+            return
+
+        calendar = self._generate_calendar(new_checkins)
         self.logger.debug("Calendar has {} events".format(len(calendar.events)))
 
-        # Upload each event from the ics.Calendar object
-        for event in calendar.events:
-            self.logger.debug("Uploading event with UID: {}".format(event.uid))
+        # Upload the events from the ics.Calendar object, several at once:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            uploaded = list(
+                executor.map(lambda event: self._upload_event(cal, event), calendar.events)
+            )
+
+        failures = uploaded.count(False)
+        if failures:
+            plural = "" if failures == 1 else "s"
+            self.logger.error("Failed to upload {} event{}".format(failures, plural))
+            exit(1)
+
+    def _get_existing_events(self, cal) -> dict:
+        """Returns a dict of all the events already in the CalDAV calendar,
+        fetched with a single request, keyed by their UIDs.
+
+        Keyword arguments:
+        cal -- The caldav Calendar to look in.
+        """
+        events = {str(e.icalendar_component["UID"]): e for e in cal.events()}
+        self.logger.debug("Found {} events on the server".format(len(events)))
+        return events
+
+    @staticmethod
+    def _is_event_current(server_event, checkin: dict) -> bool:
+        """Returns True if the event on the CalDAV server starts at the
+        checkin's time, so doesn't need uploading again.
+
+        Keyword arguments:
+        server_event -- The caldav Event already on the server.
+        checkin -- A dict of data about a single checkin.
+        """
+        dtstart = server_event.icalendar_component.get("DTSTART")
+        if dtstart is None:
+            return False
+        start = datetime.fromtimestamp(checkin["createdAt"], tz=timezone.utc)
+        return dtstart.dt == start
+
+    def _upload_event(self, cal, event: Event) -> bool:
+        """Uploads a single event to the CalDAV calendar.
+
+        Returns True if it was uploaded, False if the server rejected it.
+
+        Keyword arguments:
+        cal -- The caldav Calendar to add the event to.
+        event -- The ics Event to upload.
+        """
+        from caldav.lib.error import PutError
+
+        self.logger.debug("Uploading event with UID: {}".format(event.uid))
+        try:
             cal.add_event(event.serialize())
+        except PutError as err:
+            self.logger.error("Error uploading event {}: {}".format(event.uid, err))
+            return False
+        return True
 
 
 def main():
@@ -269,9 +677,10 @@ def main():
         "-k",
         "--kind",
         action="store",
-        help="Either ics, or caldav. Default is ics.",
+        nargs="+",
+        help="One or more of ics and caldav. Default is ics.",
         choices=VALID_KINDS,
-        default="ics",
+        default=["ics"],
         required=False,
         type=str,
     )
@@ -307,11 +716,8 @@ def main():
 
     generator = FeedGenerator(config_file=args.config, fetch=to_fetch)
 
-    if args.kind == "caldav":
-        generator.sync_calendar_to_caldav()
-    else:
-        # Generate the requested kind of file
-        generator.generate(kind=args.kind)
+    # Generate the requested kinds of file
+    generator.generate(kinds=args.kind)
 
 if __name__ == "__main__":
     import sys